@@ -1,16 +1,24 @@
 # Copyright (c) 2020-2029 Alex Carrega <contact@alexcarrega.com>
 # author: Alex Carrega <contact@alexcarrega.com>
 
+import atexit
 import json
+import os
+import re
+import shlex
+import shutil
+import sys
 import threading
 from datetime import datetime
+from html import escape
+from importlib.util import find_spec
 from string import Template
 from subprocess import PIPE, CompletedProcess, run
-from typing import Iterable, List, Optional, Tuple, TypeVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
 
 from bs4 import BeautifulSoup
-from bunch import Bunch
 from dynaconf import Dynaconf
+from dynaconf.vendor.ruamel.yaml.error import YAMLError
 from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
 from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.document import Document
@@ -19,29 +27,110 @@ from prompt_toolkit.history import FileHistory
 from prompt_toolkit.shortcuts.prompt import PromptSession
 from prompt_toolkit.validation import ValidationError, Validator
 from pygments import formatters, highlight, lexers
+from pygments.lexer import Lexer
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+T_Config = TypeVar('T_Config', bound='Config')
 T_Data = TypeVar('T_Data', bound='Data')
 
 NOT_AVAILABLE = 'N.A.'
+SETTINGS_FILES = ['settings.yaml', '.secrets.yaml']
+SETTINGS_CHECK_INTERVAL = 1.0
+SETTINGS_ERRORS = (OSError, AttributeError, TypeError, ValueError, YAMLError)
+TRIE_END = ''
+ARG_KEYS = [f'arg_{i}' for i in range(1, 33)]
+LONG_INTEGER = re.compile(r'\d{19,}')
+SHELL_METACHARS = re.compile(r'[|&;<>()$`*?~#\[\]{}!=\n]')
+HTML_PARSER = 'lxml' if find_spec('lxml') else 'html5lib'
+HTML_LEXER = lexers.HtmlLexer()
+JSON_LEXER = lexers.JsonLexer()
+TERMINAL_FORMATTER = formatters.TerminalFormatter()
+HIGHLIGHT_MAX_SIZE = 1_000_000
+IS_TTY = sys.stdout.isatty()
+JSON_ERROR_TEMPLATE = '\nError: {error}\nInput: {args}\nOutput: {stdout}\nMessage: {stderr}\n'
+TOOLBAR_TEMPLATE = ('<aaa fg="blue" bg="white"> - Time: <b>{time}</b> </aaa>'
+                    '<aaa fg="lightyellow"> - Duration: <b>{duration}</b> </aaa>'
+                    '<aaa fg="dark{style}" bg="white"> - Return code: <b>{ret_code}</b> </aaa>')
+SETTINGS_ERROR_TEMPLATE = '<aaa fg="white" bg="darkred"> - Settings not reloaded: <b>{error}</b> </aaa>'
 
 
 def get_keys(data: Iterable[str]) -> List[str]:
     return list(map(lambda item: item.strip().lower(), data))
 
 
+def build_trie(keys: Iterable[str]) -> Dict[str, Any]:
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[TRIE_END] = key
+    return trie
+
+
+def match_prefix(trie: Dict[str, Any], text: str) -> Optional[str]:
+    node, match = trie, trie.get(TRIE_END)
+    for char in text:
+        node = node.get(char)
+        if node is None:
+            break
+        match = node.get(TRIE_END, match)
+    return match
+
+
+def get_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Config:
+    def __init__(self: T_Config):
+        self.settings = Dynaconf(settings_files=SETTINGS_FILES)
+        self.available_commands = get_keys(self.settings.get('commands', {}).keys()) + ['q']
+        self.available_commands_trie = build_trie(self.available_commands)
+        self.commands_trie = build_trie(self.settings.get('commands', {}).keys())
+        self.templates = {}
+        self.vars = dict(self.settings.get('vars', {}) or {})
+        self.prompt = f'{self.settings.prompt} '
+
+
 class Data:
     def __init__(self: T_Data):
-        self.update()
+        self._mtimes = {}
+        self.executables = {}
+        self.settings_error = None
+        self._reload_if_changed()
         self.last_exec_start = NOT_AVAILABLE
         self.last_exec_end = datetime.now()
         self.last_exec_ret_code = NOT_AVAILABLE
+        self._stop = threading.Event()
+        atexit.register(self._stop.set)
+        threading.Thread(target=self._watch, daemon=True).start()
 
     def update(self: T_Data) -> None:
-        self.settings = Dynaconf(settings_files=["settings.yaml", ".secrets.yaml"])
-        self.available_commands = get_keys(self.settings.get('commands', {}).keys()) + ['q']
-        t = threading.Timer(1, self.update)
-        t.daemon = True
-        t.start()
+        self.config = Config()
+
+    def _reload_if_changed(self: T_Data) -> bool:
+        mtimes = {path: get_mtime(path) for path in SETTINGS_FILES}
+        if mtimes == self._mtimes:
+            return False
+        self._mtimes = mtimes
+        self.update()
+        self.settings_error = None
+        return True
+
+    def _watch(self: T_Data) -> None:
+        while not self._stop.wait(SETTINGS_CHECK_INTERVAL):
+            try:
+                self._reload_if_changed()
+            except SETTINGS_ERRORS as error:
+                self.settings_error = ' '.join(str(error).split()) or type(error).__name__
 
 
 T_CommandValidator = TypeVar('T_CommandValidator', bound='CommandValidator')
@@ -53,97 +142,162 @@ class CommandValidator(Validator):
 
     def validate(self: T_CommandValidator, document: Document) -> None:
         text = document.text.strip().lower()
-        if not text.startswith(tuple(self.data.available_commands)):
+        if match_prefix(self.data.config.available_commands_trie, text) is None:
             raise ValidationError(message=f'Command {text} not found')
 
 
-def exec(command: str, args: str, data: Data) -> CompletedProcess[str]:
+def get_argv(command: str, data: Data) -> Optional[List[str]]:
+    if SHELL_METACHARS.search(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if not argv:
+        return None
+    program = argv[0]
+    if os.sep not in program:
+        if program not in data.executables:
+            data.executables[program] = shutil.which(program)
+        if data.executables[program] is None:
+            return None
+        argv[0] = data.executables[program]
+    return argv
+
+
+def get_template(command: str, config: Config) -> Template:
+    template = config.templates.get(command)
+    if template is None:
+        template = config.templates[command] = Template(command)
+    return template
+
+
+def exec(command: str, args: List[str], data: Data, stream: bool = False) -> CompletedProcess[str]:
     data.last_exec_start = datetime.now()
-    args = list(filter(lambda arg: arg.strip(), args))
-    args_dict = {f'arg_{i}': v for i, v in enumerate(args, 1)}
+    if len(args) <= len(ARG_KEYS):
+        args_dict = dict(zip(ARG_KEYS, args))
+    else:
+        args_dict = {f'arg_{i}': v for i, v in enumerate(args, 1)}
     args_dict['args'] = '\n'.join(args)
     try:
-        command = Template(command).substitute(**data.settings.get('vars', {}), **args_dict)
-        output = run(command, check=False, shell=True,
-                     stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        config = data.config
+        command = get_template(command, config).substitute(**config.vars, **args_dict)
+        argv = get_argv(command, data)
+        pipe = None if stream else PIPE
+        output = None
+        if argv is not None:
+            try:
+                output = run(argv, check=False, close_fds=False,
+                             stdout=pipe, stderr=pipe, universal_newlines=True)
+            except OSError:
+                data.executables.clear()
+        if output is None:
+            output = run(command, check=False, shell=True,
+                         stdout=pipe, stderr=pipe, universal_newlines=True)
     except KeyError as key_error:
-        return Bunch(args=command, stdout=NOT_AVAILABLE, stderr=f'Variable not found: {key_error}', returncode=1)
+        return CompletedProcess(args=command, returncode=1, stdout=NOT_AVAILABLE, stderr=f'Variable not found: {key_error}')
     data.last_exec_end = datetime.now()
     data.last_exec_ret_code = output.returncode
     return output
 
 
-def default(text: str) -> str:
-    return text or NOT_AVAILABLE
+def pretty_json(text: str) -> str:
+    json_data = None
+    if orjson is not None and not LONG_INTEGER.search(text):
+        try:
+            json_data = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    if json_data is None:
+        json_data = json.loads(text)
+    return json.dumps(json_data, indent=4, sort_keys=True)
+
+
+def colorize(text: str, lexer: Lexer) -> str:
+    if IS_TTY and len(text) < HIGHLIGHT_MAX_SIZE:
+        return highlight(text, lexer, TERMINAL_FORMATTER)
+    return text
 
 
 def format(data: CompletedProcess[str], type: str, lines: bool) -> str:
     if type == 'html':
-        output = BeautifulSoup(data.stdout, features='html5lib').prettify()
-        output = highlight(output, lexers.HtmlLexer(), formatters.TerminalFormatter())
+        output = BeautifulSoup(data.stdout, features=HTML_PARSER).prettify()
+        output = colorize(output, HTML_LEXER)
     elif type == 'json':
         try:
-            json_data = json.loads(data.stdout)
-            output = json.dumps(json_data, indent=4, sort_keys=True)
-            output = highlight(output, lexers.JsonLexer(), formatters.TerminalFormatter())
-        except Exception as exception:
-
-            output = f'\nError: {exception}\nInput: {data.args}\nOutput: {default(data.stdout)}\nMessage: {default(data.stderr)}\n'
+            output = pretty_json(data.stdout)
+            output = colorize(output, JSON_LEXER)
+        except (ValueError, RecursionError) as exception:
+            output = JSON_ERROR_TEMPLATE.format_map({'error': exception, 'args': data.args,
+                                                     'stdout': data.stdout or NOT_AVAILABLE,
+                                                     'stderr': data.stderr or NOT_AVAILABLE})
     elif type == 'std':
-        output = data
+        output = data.stdout
     if lines:
-        return '\n'.join(map(lambda line: '{0:>5}'.format(line[0]) + '.\t' + line[1], enumerate(output.split('\n'))))
+        return '\n'.join([f'{i:>5}.\t{line}' for i, line in enumerate(output.split('\n'))])
     else:
         return output
 
 
-def bottom_toolbar(data):
-    ret_code_style = 'red' if data.last_exec_ret_code == NOT_AVAILABLE or data.last_exec_ret_code > 0 else 'green'
-    if data.last_exec_start == NOT_AVAILABLE:
-        duration = NOT_AVAILABLE
-    else:
-        duration = (data.last_exec_end - data.last_exec_start).total_seconds()
-    return lambda: HTML(f'<aaa fg="blue" bg="white"> - Time: <b>{data.last_exec_end}</b> ' +
-                        f'</aaa><aaa fg="lightyellow"> - Duration: <b>{duration}</b> ' +
-                        f'</aaa><aaa fg="dark{ret_code_style}" bg="white"> - '
-                        f'Return code: <b>{data.last_exec_ret_code}</b> </aaa>')
+def bottom_toolbar(data: Data) -> Callable[[], HTML]:
+    cache = {}
+
+    def toolbar() -> HTML:
+        key = (data.last_exec_start, data.last_exec_end, data.last_exec_ret_code, data.settings_error)
+        if cache.get('key') != key:
+            ret_code_style = 'red' if data.last_exec_ret_code == NOT_AVAILABLE or data.last_exec_ret_code > 0 else 'green'
+            if data.last_exec_start == NOT_AVAILABLE:
+                duration = NOT_AVAILABLE
+            else:
+                duration = (data.last_exec_end - data.last_exec_start).total_seconds()
+            markup = TOOLBAR_TEMPLATE.format_map({'time': data.last_exec_end, 'duration': duration,
+                                                  'style': ret_code_style, 'ret_code': data.last_exec_ret_code})
+            if data.settings_error is not None:
+                markup += SETTINGS_ERROR_TEMPLATE.format_map({'error': escape(data.settings_error)})
+            cache['key'] = key
+            cache['html'] = HTML(markup)
+        return cache['html']
+    return toolbar
 
 
 def get_command(input: str, data: Data) -> Tuple[Optional[str], Optional[str]]:
-    return next(
-        (
-            (cmd_key, cmd_data)
-            for cmd_key, cmd_data in data.settings.commands.items()
-            if input.startswith(cmd_key)
-        ),
-        (None, None),
-    )
+    config = data.config
+    cmd_key = match_prefix(config.commands_trie, input)
+    if cmd_key is None:
+        return None, None
+    return cmd_key, config.settings.commands[cmd_key]
 
 
 def main():
     data = Data()
-    session = PromptSession(history=FileHistory('.prompt-able'))
+    session = PromptSession(lambda: data.config.prompt,
+                            history=FileHistory('.prompt-able'),
+                            bottom_toolbar=bottom_toolbar(data),
+                            auto_suggest=AutoSuggestFromHistory(),
+                            completer=WordCompleter(lambda: data.config.available_commands),
+                            validator=CommandValidator(data),
+                            validate_while_typing=False)
 
     while True:
         try:
-            input = session.prompt(f'{data.settings.prompt} ',
-                                   bottom_toolbar=bottom_toolbar(data),
-                                   auto_suggest=AutoSuggestFromHistory(),
-                                   completer=WordCompleter(data.available_commands),
-                                   validator=CommandValidator(data),
-                                   validate_while_typing=False).strip().lower()
+            input = session.prompt().strip().lower()
             command_key, command_data = get_command(input, data)
             if command_data:
                 type = command_data.output.strip().lower()
                 lines = command_data.lines
-                args = input.replace(command_key, '').split(' ')
-                output_process = exec(command_data.exec, args, data)
-                output = format(output_process, type, lines)
-                print(output)
+                _, _, rest = input.partition(command_key)
+                args = rest.split()
+                output_process = exec(command_data.exec, args, data, stream=type == 'std' and not lines)
+                if output_process.stdout is not None:
+                    print(format(output_process, type, lines))
+                if type == 'std' and output_process.stderr:
+                    print(output_process.stderr.rstrip('\n'), file=sys.stderr)
             elif input == 'q':
-                exit(0)
-        except KeyboardInterrupt or EOFError as err:
-            print(err)
+                return
+        except KeyboardInterrupt:
+            continue
+        except EOFError:
+            return
 
 
 if __name__ == '__main__':